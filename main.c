@@ -11,7 +11,8 @@
 
 #define size_of_attribute(Struct, Attribute) sizeof(((Struct*)0)->Attribute)
 
-#define DIR_PREFIX "data/"
+#define DEFAULT_DATA_DIR "data"
+#define DATA_DIR_ENV "DB_DATA_DIR"
 
 #define TABLE_MAX_PAGES 100
 
@@ -21,6 +22,8 @@
 
 typedef enum {
   META_COMMAND_SUCCESS,
+  META_COMMAND_EXIT,
+  META_COMMAND_FAILURE,
   META_COMMAND_UNRECOGNIZED_COMMAND
 } MetaCommandResult;
 
@@ -43,7 +46,7 @@ typedef enum {
   STATEMENT_SELECT
 } StatementType;
 
-typedef enum { INTEGER, VARCHAR, REAL } ColumnType;
+typedef enum { INTEGER, VARCHAR, REAL, UNKNOWN_TYPE } ColumnType;
 
 typedef enum {
   OP_EQUAL,
@@ -161,7 +164,7 @@ ColumnType string_to_column_type(const char* str) {
   if (strcmp(str, "varchar") == 0) return VARCHAR;
   if (strcmp(str, "real") == 0) return REAL;
   fprintf(stderr, "Unknown column type: %s\n", str);
-  exit(1);
+  return UNKNOWN_TYPE;
 }
 
 void free_table(Table* table) {
@@ -171,6 +174,19 @@ void free_table(Table* table) {
 
   free(table->table_name);
   free(table->filename);
+
+  // Only set when opening the database failed part way through; table_close
+  // releases the pager otherwise.
+  Pager* pager = table->pager;
+  if (pager) {
+    close(pager->file_descriptor);
+    for (uint32_t i = 0; i < TABLE_MAX_PAGES; i++) {
+      free(pager->pages[i]);
+    }
+    free(pager);
+    table->pager = NULL;
+  }
+
   if (!table->columns) {
     return;
   }
@@ -199,12 +215,17 @@ Pager* pager_open(const char* filename) {
   int fd = open(filename, O_RDWR | O_CREAT, S_IWUSR | S_IRUSR);
   if (fd < 0) {
     printf("Unable to open file\n");
-    exit(EXIT_FAILURE);
+    return NULL;
   }
 
   off_t file_length = lseek(fd, 0, SEEK_END);
 
   Pager* pager = malloc(sizeof(Pager));
+  if (pager == NULL) {
+    printf("Memory allocation error\n");
+    close(fd);
+    return NULL;
+  }
   pager->file_descriptor = fd;
   pager->file_length = file_length;
 
@@ -215,37 +236,40 @@ Pager* pager_open(const char* filename) {
   return pager;
 }
 
-void pager_flush(Pager* pager, uint32_t page_num, uint32_t size) {
+bool pager_flush(Pager* pager, uint32_t page_num, uint32_t size) {
   if (pager->pages[page_num] == NULL) {
     printf("Tried to flush null page\n");
-    exit(EXIT_FAILURE);
+    return false;
   }
 
   off_t offset = lseek(pager->file_descriptor, page_num * PAGE_SIZE, SEEK_SET);
   if (offset < 0) {
     printf("Error seeking: %d\n", errno);
-    exit(EXIT_FAILURE);
+    return false;
   }
 
   ssize_t bytes_written =
       write(pager->file_descriptor, pager->pages[page_num], size);
   if (bytes_written < 0) {
     printf("Error writing: %d\n", errno);
-    exit(EXIT_FAILURE);
+    return false;
   }
+
+  return true;
 }
 
 Schema* schema_open(const char* filename) {
   FILE* file = fopen(filename, "r");
   if (file == NULL) {
     printf("Error opening schema file\n");
+    return NULL;
   }
 
   Schema* schema = malloc(sizeof(Schema));
   if (schema == NULL) {
     printf("Memory allocation error\n");
     fclose(file);
-    exit(EXIT_FAILURE);
+    return NULL;
   }
 
   schema->tables = NULL;
@@ -256,7 +280,7 @@ Schema* schema_open(const char* filename) {
     printf("Error reading number of tables\n");
     fclose(file);
     free_schema(schema);
-    exit(EXIT_FAILURE);
+    return NULL;
   }
 
   schema->num_tables = atoi(line);
@@ -265,11 +289,13 @@ Schema* schema_open(const char* filename) {
     printf("Memory allocation error\n");
     fclose(file);
     free_schema(schema);
-    exit(EXIT_FAILURE);
+    return NULL;
   }
 
   for (uint32_t i = 0; i < schema->num_tables; i++) {
     schema->tables[i].table_name = NULL;
+    schema->tables[i].filename = NULL;
+    schema->tables[i].pager = NULL;
     schema->tables[i].columns = NULL;
     schema->tables[i].num_columns = 0;
   }
@@ -279,7 +305,7 @@ Schema* schema_open(const char* filename) {
       printf("Error reading table definition\n");
       fclose(file);
       free_schema(schema);
-      exit(EXIT_FAILURE);
+      return NULL;
     }
 
     size_t len = strlen(line);
@@ -296,18 +322,18 @@ Schema* schema_open(const char* filename) {
       printf("Memory allocation error\n");
       fclose(file);
       free_schema(schema);
-      exit(EXIT_FAILURE);
+      return NULL;
     }
 
     token = strtok(NULL, ";");
     table->num_columns = atoi(token);
 
-    table->columns = malloc(table->num_columns * sizeof(ColumnDefinition));
+    table->columns = calloc(table->num_columns, sizeof(ColumnDefinition));
     if (table->columns == NULL) {
       printf("Memory allocation error\n");
       fclose(file);
       free_schema(schema);
-      exit(EXIT_FAILURE);
+      return NULL;
     }
 
     char* outer_ptr = NULL;
@@ -320,9 +346,10 @@ Schema* schema_open(const char* filename) {
           strtok_r(j == 0 ? column_defs_cpy : NULL, ",", &outer_ptr);
       if (column_def == NULL) {
         printf("Error parsing column definition\n");
+        free(column_defs_cpy);
         fclose(file);
         free_schema(schema);
-        exit(EXIT_FAILURE);
+        return NULL;
       }
 
       char* column_name = strtok_r(column_def, ":", &inner_ptr);
@@ -332,20 +359,36 @@ Schema* schema_open(const char* filename) {
       table->columns[j].name = strdup(column_name);
       if (table->columns[j].name == NULL) {
         fprintf(stderr, "Memory allocation error\n");
+        free(column_defs_cpy);
         fclose(file);
         free_schema(schema);
-        exit(EXIT_FAILURE);
+        return NULL;
       }
       table->columns[j].size = atoi(column_size);
       table->columns[j].type = string_to_column_type(column_type);
+      if (table->columns[j].type == UNKNOWN_TYPE) {
+        free(column_defs_cpy);
+        fclose(file);
+        free_schema(schema);
+        return NULL;
+      }
     }
+    free(column_defs_cpy);
   }
 
   fclose(file);
   return schema;
 }
 
-void schema_fill(Schema* schema) {
+const char* get_data_dir() {
+  const char* data_dir = getenv(DATA_DIR_ENV);
+  if (data_dir == NULL || data_dir[0] == '\0') {
+    return DEFAULT_DATA_DIR;
+  }
+  return data_dir;
+}
+
+bool schema_fill(Schema* schema, const char* data_dir) {
   for (uint32_t i = 0; i < schema->num_tables; i++) {
     Table* table = &schema->tables[i];
     uint32_t row_size = 0;
@@ -357,16 +400,18 @@ void schema_fill(Schema* schema) {
     uint32_t rows_per_page = PAGE_SIZE / row_size;
     uint32_t table_max_rows = rows_per_page * TABLE_MAX_PAGES;
 
-    char* filename = malloc(strlen(table->table_name) + strlen(DIR_PREFIX) + 7);
+    char* filename = malloc(strlen(data_dir) + strlen(table->table_name) + 8);
     if (filename == NULL) {
       printf("Memory allocation error\n");
-      free_schema(schema);
-      return;
+      return false;
     }
-    sprintf(filename, "%s%s.table", DIR_PREFIX, table->table_name);
+    sprintf(filename, "%s/%s.table", data_dir, table->table_name);
     table->filename = filename;
 
     Pager* pager = pager_open(table->filename);
+    if (pager == NULL) {
+      return false;
+    }
     uint32_t num_pages = pager->file_length / PAGE_SIZE;
     uint32_t bytes_remaining = pager->file_length % PAGE_SIZE;
     uint32_t num_rows =
@@ -378,28 +423,38 @@ void schema_fill(Schema* schema) {
     table->max_rows = table_max_rows;
     table->num_rows = num_rows;
   }
+
+  return true;
 }
 
-Schema* db_open(const char* filename) {
+// Returns NULL when the schema or any table file cannot be opened.
+Schema* db_open(const char* filename, const char* data_dir) {
   Schema* schema = schema_open(filename);
   if (schema == NULL) {
     printf("Error opening schema\n");
-    exit(EXIT_FAILURE);
+    return NULL;
+  }
+
+  if (!schema_fill(schema, data_dir)) {
+    free_schema(schema);
+    return NULL;
   }
-  schema_fill(schema);
 
   return schema;
 }
 
-void table_close(Table* table) {
+// Frees the pager even when a write fails, so the table is always closed;
+// returns false if any of its rows could not be written back.
+bool table_close(Table* table) {
   Pager* pager = table->pager;
+  bool flushed = true;
   uint32_t num_full_pages = table->num_rows / table->rows_per_page;
 
   for (uint32_t i = 0; i < num_full_pages; i++) {
     if (pager->pages[i] == NULL) {
       continue;
     }
-    pager_flush(pager, i, PAGE_SIZE);
+    flushed = pager_flush(pager, i, PAGE_SIZE) && flushed;
     free(pager->pages[i]);
     pager->pages[i] = NULL;
   }
@@ -409,7 +464,9 @@ void table_close(Table* table) {
   if (num_additional_rows > 0) {
     uint32_t page_num = num_full_pages;
     if (pager->pages[page_num] != NULL) {
-      pager_flush(pager, page_num, num_additional_rows * table->row_size);
+      flushed = pager_flush(pager, page_num,
+                            num_additional_rows * table->row_size) &&
+                flushed;
       free(pager->pages[page_num]);
       pager->pages[page_num] = NULL;
     }
@@ -418,7 +475,7 @@ void table_close(Table* table) {
   int result = close(pager->file_descriptor);
   if (result < 0) {
     printf("Error closing db file.\n");
-    exit(EXIT_FAILURE);
+    flushed = false;
   }
 
   for (uint32_t i = 0; i < TABLE_MAX_PAGES; i++) {
@@ -430,18 +487,55 @@ void table_close(Table* table) {
   }
 
   free(pager);
+  table->pager = NULL;
+
+  return flushed;
+}
+
+bool table_reset(Table* table, FILE* out) {
+  Pager* pager = table->pager;
+  for (uint32_t i = 0; i < TABLE_MAX_PAGES; i++) {
+    if (pager->pages[i]) {
+      free(pager->pages[i]);
+      pager->pages[i] = NULL;
+    }
+  }
+
+  pager->file_length = 0;
+  table->num_rows = 0;
+
+  if (ftruncate(pager->file_descriptor, 0) < 0) {
+    fprintf(out, "Error truncating db file: %d\n", errno);
+    return false;
+  }
+
+  return true;
 }
 
-void db_close(Schema* schema) {
+bool db_reset(Schema* schema, FILE* out) {
+  bool reset = true;
+  for (uint32_t i = 0; i < schema->num_tables; i++) {
+    reset = table_reset(&(schema->tables[i]), out) && reset;
+  }
+  return reset;
+}
+
+// Closes every table and frees the schema; returns false if any table could
+// not be written back to disk.
+bool db_close(Schema* schema) {
+  bool closed = true;
   for (uint32_t i = 0; i < schema->num_tables; i++) {
     Table* table = &(schema->tables[i]);
-    table_close(table);
+    closed = table_close(table) && closed;
   }
 
-  free(schema->tables);
-  free(schema);
+  free_schema(schema);
+  return closed;
 }
 
+// Still exits on failure: cursor_value() and the execute_* functions built on
+// it have no error path. execute_insert() stops at max_rows, so the bounds
+// check cannot trip through db_exec(); a failed read can.
 void* get_page(Pager* pager, uint32_t page_num) {
   if (page_num > TABLE_MAX_PAGES) {
     printf("Tried to fetch page number out of bounds. %d > %d\n", page_num,
@@ -544,10 +638,15 @@ void read_input(InputBuffer* input_buffer) {
   input_buffer->buffer[bytes_read - 1] = 0;
 }
 
-MetaCommandResult do_meta_cmd(InputBuffer* input_buffer, Schema* schema) {
+MetaCommandResult do_meta_cmd(InputBuffer* input_buffer, Schema* schema,
+                              FILE* out) {
   if (strcmp(input_buffer->buffer, ".exit") == 0) {
-    db_close(schema);
-    exit(EXIT_SUCCESS);
+    return META_COMMAND_EXIT;
+  } else if (strcmp(input_buffer->buffer, ".reset") == 0) {
+    if (!db_reset(schema, out)) {
+      return META_COMMAND_FAILURE;
+    }
+    return META_COMMAND_SUCCESS;
   } else {
     return META_COMMAND_UNRECOGNIZED_COMMAND;
   }
@@ -603,6 +702,9 @@ PrepareResult copy_value_into_bytes(ColumnDefinition* column, Bytes* bytes,
 
       return PREPARE_SUCCESS;
     }
+    case UNKNOWN_TYPE:
+      // schema_open() rejects tables with unknown column types
+      return PREPARE_INTERNAL_ERROR;
   }
 }
 
@@ -743,7 +845,6 @@ PrepareResult prepare_update(InputBuffer* input_buffer, Statement* statement,
   char* cpy = strdup(input_buffer->buffer);
   if (!cpy) {
     free(update_statement);
-    printf("strdup cpy\n");
     return PREPARE_INTERNAL_ERROR;
   }
 
@@ -754,7 +855,6 @@ PrepareResult prepare_update(InputBuffer* input_buffer, Statement* statement,
     free(cpy);
     free(lower_sql);
     free(update_statement);
-    printf("update\n");
     return PREPARE_SYNTAX_ERROR;
   }
 
@@ -763,7 +863,6 @@ PrepareResult prepare_update(InputBuffer* input_buffer, Statement* statement,
     free(cpy);
     free(lower_sql);
     free(update_statement);
-    printf("set_pos\n");
     return PREPARE_SYNTAX_ERROR;
   }
 
@@ -772,7 +871,6 @@ PrepareResult prepare_update(InputBuffer* input_buffer, Statement* statement,
     free(cpy);
     free(lower_sql);
     free(update_statement);
-    printf("where_pos\n");
     return PREPARE_SYNTAX_ERROR;
   }
 
@@ -820,7 +918,6 @@ PrepareResult prepare_update(InputBuffer* input_buffer, Statement* statement,
     free(lower_sql);
     free(table_name);
     free(update_statement);
-    printf("column\n");
     return PREPARE_SYNTAX_ERROR;
   }
 
@@ -1216,7 +1313,8 @@ ExecuteResult execute_insert(Statement* statement) {
   return EXECUTE_SUCCESS;
 }
 
-void print_row(Row* row, Table* table, SelectStatement* select_statement) {
+void print_row(Row* row, Table* table, SelectStatement* select_statement,
+               FILE* out) {
   uint32_t num_columns = select_statement->is_select_all
                              ? table->num_columns
                              : select_statement->num_columns;
@@ -1224,29 +1322,29 @@ void print_row(Row* row, Table* table, SelectStatement* select_statement) {
                                   ? table->columns
                                   : select_statement->columns;
 
-  printf("(");
+  fprintf(out, "(");
   for (uint32_t i = 0; i < num_columns; i++) {
     ColumnDefinition column = columns[i];
     if (column.type == INTEGER) {
       int value;
       memcpy(&value, row->data + column.offset, column.size);
-      printf("%d", value);
+      fprintf(out, "%d", value);
     } else if (column.type == VARCHAR) {
       char* value = malloc(column.size + 1);
       memcpy(value, row->data + column.offset, column.size);
       value[column.size] = '\0';
-      printf("%s", value);
+      fprintf(out, "%s", value);
     } else if (column.type == REAL) {
       float value;
       memcpy(&value, row->data + column.offset, column.size);
-      printf("%f", value);
+      fprintf(out, "%f", value);
     }
     if (i < num_columns - 1) {
-      printf(", ");
+      fprintf(out, ", ");
     }
   }
 
-  printf(")\n");
+  fprintf(out, ")\n");
 }
 
 bool valid_where_clause(Row* row, WhereClause* where_clause) {
@@ -1255,6 +1353,9 @@ bool valid_where_clause(Row* row, WhereClause* where_clause) {
   Bytes value = where_clause->value;
 
   switch (column->type) {
+    case UNKNOWN_TYPE:
+      // schema_open() rejects tables with unknown column types
+      return false;
     case INTEGER: {
       int int_value;
       memcpy(&int_value, row->data + column->offset, column->size);
@@ -1312,7 +1413,7 @@ bool valid_where_clause(Row* row, WhereClause* where_clause) {
   }
 }
 
-ExecuteResult execute_select(Statement* statement) {
+ExecuteResult execute_select(Statement* statement, FILE* out) {
   SelectStatement* select_statement = statement->statementDetail;
   Table* table = statement->table;
   WhereClause* where_clause = select_statement->where_clause;
@@ -1328,7 +1429,7 @@ ExecuteResult execute_select(Statement* statement) {
       continue;
     }
 
-    print_row(&row, table, select_statement);
+    print_row(&row, table, select_statement, out);
     cursor_advance(cursor);
   }
 
@@ -1426,12 +1527,12 @@ ExecuteResult execute_delete(Statement* statement) {
   return EXECUTE_SUCCESS;
 }
 
-ExecuteResult execute_statement(Statement* statement) {
+ExecuteResult execute_statement(Statement* statement, FILE* out) {
   switch (statement->type) {
     case STATEMENT_INSERT:
       return execute_insert(statement);
     case STATEMENT_SELECT:
-      return execute_select(statement);
+      return execute_select(statement, out);
     case STATEMENT_UPDATE:
       return execute_update(statement);
     case STATEMENT_DELETE:
@@ -1439,8 +1540,110 @@ ExecuteResult execute_statement(Statement* statement) {
   }
 }
 
-void print_prompt() { printf("db > "); }
+// Runs one line of input and writes the response to out. Returns false when
+// the line asks to exit; closing the database is left to the caller.
+bool execute_line(InputBuffer* input_buffer, Schema* schema, FILE* out) {
+  if (input_buffer->buffer[0] == '.') {
+    MetaCommandResult meta_command_result = do_meta_cmd(input_buffer, schema, out);
+    switch (meta_command_result) {
+      case META_COMMAND_SUCCESS:
+        return true;
+      case META_COMMAND_EXIT:
+        return false;
+      case META_COMMAND_FAILURE:
+        // the command already reported what went wrong
+        return true;
+      case META_COMMAND_UNRECOGNIZED_COMMAND:
+        fprintf(out, "Unrecognized command '%s'\n", input_buffer->buffer);
+        return true;
+    }
+  }
+
+  Statement statement;
+  PrepareResult prepare_result =
+      prepare_statement(input_buffer, &statement, schema);
+  switch (prepare_result) {
+    case PREPARE_SUCCESS:
+      break;
+    case PREPARE_NEGATIVE_ID:
+      fprintf(out, "ID must be positive.\n");
+      return true;
+    case PREPARE_STRING_TOO_LONG:
+      fprintf(out, "String is too long.\n");
+      return true;
+    case PREPARE_UNRECOGNIZED_STATEMENT:
+      fprintf(out, "Unrecognized keyword at start of '%s'.\n",
+              input_buffer->buffer);
+      return true;
+    case PREPARE_INTERNAL_ERROR:
+      fprintf(out, "Internal error.\n");
+      return true;
+    case PREPARE_SYNTAX_ERROR:
+      fprintf(out, "Syntax error.\n");
+      return true;
+    case PREPARE_TABLE_NOT_FOUND:
+      fprintf(out, "Table not found.\n");
+      return true;
+  }
+
+  ExecuteResult execute_result = execute_statement(&statement, out);
+  switch (execute_result) {
+    case EXECUTE_SUCCESS:
+      fprintf(out, "Executed.\n");
+      break;
+    case EXECUTE_TABLE_FULL:
+      fprintf(out, "Error: Table full.\n");
+      break;
+  }
+
+  return true;
+}
+
+// Entry point for libdb.so: runs one line against a database returned by
+// db_open() and returns what the REPL would have printed for it. Returns NULL
+// for .exit, which only the REPL handles, and when memory runs out. The
+// caller frees the returned string.
+char* db_exec(Schema* schema, const char* line) {
+  InputBuffer* input_buffer = new_input_buffer();
+  input_buffer->buffer = strdup(line);
+  if (input_buffer->buffer == NULL) {
+    free(input_buffer);
+    return NULL;
+  }
+  input_buffer->input_length = strlen(line);
+  input_buffer->buffer_length = input_buffer->input_length + 1;
+
+  char* output = NULL;
+  size_t output_length = 0;
+  FILE* out = open_memstream(&output, &output_length);
+  if (out == NULL) {
+    free(input_buffer->buffer);
+    free(input_buffer);
+    return NULL;
+  }
+
+  bool keep_going = execute_line(input_buffer, schema, out);
+  fclose(out);
+
+  free(input_buffer->buffer);
+  free(input_buffer);
+
+  if (!keep_going) {
+    free(output);
+    return NULL;
+  }
+
+  return output;
+}
+
+void print_prompt() {
+  printf("db > ");
+  // Flush so a client reading through a pipe sees the prompt and knows the
+  // previous command has finished.
+  fflush(stdout);
+}
 
+#ifndef DB_LIBRARY
 int main(int argc, char* argv[]) {
   if (argc < 2) {
     printf("Must supply a database filename.\n");
@@ -1448,59 +1651,19 @@ int main(int argc, char* argv[]) {
   }
 
   char* filename = argv[1];
-  Schema* schema = db_open(filename);
+  Schema* schema = db_open(filename, get_data_dir());
+  if (schema == NULL) {
+    exit(EXIT_FAILURE);
+  }
 
   InputBuffer* input_buffer = new_input_buffer();
   while (true) {
     print_prompt();
     read_input(input_buffer);
 
-    if (input_buffer->buffer[0] == '.') {
-      MetaCommandResult meta_command_result = do_meta_cmd(input_buffer, schema);
-      switch (meta_command_result) {
-        case META_COMMAND_SUCCESS:
-          continue;
-        case META_COMMAND_UNRECOGNIZED_COMMAND:
-          printf("Unrecognized command '%s'\n", input_buffer->buffer);
-          continue;
-      }
-    }
-
-    Statement statement;
-    PrepareResult prepare_result =
-        prepare_statement(input_buffer, &statement, schema);
-    switch (prepare_result) {
-      case PREPARE_SUCCESS:
-        break;
-      case PREPARE_NEGATIVE_ID:
-        printf("ID must be positive.\n");
-        continue;
-      case PREPARE_STRING_TOO_LONG:
-        printf("String is too long.\n");
-        continue;
-      case PREPARE_UNRECOGNIZED_STATEMENT:
-        printf("Unrecognized keyword at start of '%s'.\n",
-               input_buffer->buffer);
-        continue;
-      case PREPARE_INTERNAL_ERROR:
-        printf("Internal error.\n");
-        continue;
-      case PREPARE_SYNTAX_ERROR:
-        printf("Syntax error.\n");
-        continue;
-      case PREPARE_TABLE_NOT_FOUND:
-        printf("Table not found.\n");
-        continue;
-    }
-
-    ExecuteResult execute_result = execute_statement(&statement);
-    switch (execute_result) {
-      case EXECUTE_SUCCESS:
-        printf("Executed.\n");
-        break;
-      case EXECUTE_TABLE_FULL:
-        printf("Error: Table full.\n");
-        break;
+    if (!execute_line(input_buffer, schema, stdout)) {
+      exit(db_close(schema) ? EXIT_SUCCESS : EXIT_FAILURE);
     }
   }
 }
+#endif